@@ -1,25 +1,40 @@
+import copy
+import functools
+import hashlib
+import io
 import json
 import os
 import re
 import shutil
 import sys
 import subprocess
+import threading
 import time
-import urllib.request
 import zipfile
 import requests
 import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PurePosixPath
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
 ttbuild_path = ".tactility"
 ttbuild_version = "4.1.0"
 ttbuild_cdn = "https://cdn.tactilityproject.org"
 ttbuild_sdk_json_validity = 3600  # seconds
+ttbuild_max_download_workers = 8
 ttport = 6666
 verbose = False
+skip_build = False
+build_jobs = 1
 use_local_sdk = False
 local_base_path = None
 http_timeout_seconds = 10
+ttbuild_tool_json_path = os.path.join(ttbuild_path, "tool.json")
+is_windows = sys.platform == "win32"
+# idf.py can only be started via the shell on Windows
+shell_needed = is_windows
 
 shell_color_red = "\033[91m"
 shell_color_orange = "\033[93m"
@@ -28,6 +43,13 @@ shell_color_purple = "\033[35m"
 shell_color_cyan = "\033[36m"
 shell_color_reset = "\033[m"
 
+# A single session is shared by all requests, so connections to the CDN and the device are kept alive and reused
+http_session = requests.Session()
+http_session.headers["User-Agent"] = f"Tactility Build Tool {ttbuild_version}"
+# Only CDN traffic (https) is retried: retrying device calls could repeat an install
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3)))
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def print_help():
     print("Usage: python tactility.py [app_path] [action] [options]")
     print("")
@@ -49,6 +71,8 @@ def print_help():
     print("  --local-sdk                    Use SDK specified by environment variable TACTILITY_SDK_PATH with platform subfolders matching target platforms.")
     print("  --skip-build                   Run everything except the idf.py/CMake commands")
     print("  --verbose                      Show extra console output")
+    print("  --jobs [count]                 Build up to [count] platforms at the same time (default: 1, at most CPU count / 4)")
+    print("    The builds share the app folder: don't use this with apps that have managed components (idf_component.yml)")
     print("")
     print("Examples:")
     print("  python tactility.py Apps/Snake build esp32s3 --verbose")
@@ -56,7 +80,33 @@ def print_help():
 
 # region Core
 
-def download_file(url, filepath):
+def read_cache_headers(filepath):
+    meta_filepath = f"{filepath}.meta"
+    if not os.path.isfile(filepath) or not os.path.isfile(meta_filepath):
+        return {}
+    try:
+        with open(meta_filepath) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("lastModified"):
+        headers["If-Modified-Since"] = meta["lastModified"]
+    return headers
+
+def write_cache_headers(filepath, response):
+    meta = {
+        "etag": response.headers.get("ETag"),
+        "lastModified": response.headers.get("Last-Modified")
+    }
+    with open(f"{filepath}.meta", mode="w") as meta_file:
+        json.dump(meta, meta_file)
+
+# When conditional is True, the ETag and Last-Modified headers of the previous download are stored
+# in a .meta sidecar file and sent along with the next request, so unchanged files aren't transferred again.
+def download_file(url, filepath, conditional=False):
     global verbose
     if verbose:
         print(f"Downloading from {url} to {filepath}")
@@ -64,18 +114,30 @@ def download_file(url, filepath):
     if parsed.scheme not in ("http", "https"):
         print_error(f"Unsupported URL scheme: {parsed.scheme}")
         return False
-    request = urllib.request.Request(
-        url,
-        data=None,
-        headers={
-            "User-Agent": f"Tactility Build Tool {ttbuild_version}"
-        }
-    )
+    headers = read_cache_headers(filepath) if conditional else {}
+    # Write to a temporary file first, so an interrupted download never leaves a truncated file behind
+    partial_filepath = f"{filepath}.part"
     try:
-        with urllib.request.urlopen(request, timeout=30) as response, open(filepath, mode="wb") as file:
-            file.write(response.read())
+        with http_session.get(url, stream=True, timeout=30, headers=headers) as response:
+            if response.status_code == 304:
+                if verbose:
+                    print(f"{filepath} is up to date")
+                # Mark the cached file as fresh
+                os.utime(filepath, None)
+                return True
+            response.raise_for_status()
+            with open(partial_filepath, mode="wb") as file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    file.write(chunk)
+            os.replace(partial_filepath, filepath)
+            if conditional:
+                write_cache_headers(filepath, response)
         return True
-    except OSError as error:
+    except (requests.RequestException, OSError) as error:
+        try:
+            os.remove(partial_filepath)
+        except OSError:
+            pass
         if verbose:
             print_error(f"Failed to fetch URL {url}\n{error}")
         return False
@@ -104,7 +166,35 @@ def exit_with_error(message):
 def get_url(ip, path):
     return f"http://{ip}:{ttport}{path}"
 
-def read_properties_file(path):
+ensured_directories = set()
+
+# Creates the directory once per run: later calls for the same path don't touch the filesystem
+def ensure_directory(path):
+    if path in ensured_directories:
+        return
+    os.makedirs(path, exist_ok=True)
+    ensured_directories.add(path)
+
+# Returns the os.stat() result, or None when the path doesn't exist
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+# Parsed files are cached by path, modification time and size, so a file is only parsed again when it changed.
+# Callers receive copies, so they can't modify the cached data.
+@functools.lru_cache(maxsize=8)
+def parse_json_file(path, modification_time_ns, size):
+    with open(path) as json_file:
+        return json.load(json_file)
+
+def read_json_file(path):
+    file_stat = os.stat(path)
+    return copy.deepcopy(parse_json_file(path, file_stat.st_mtime_ns, file_stat.st_size))
+
+@functools.lru_cache(maxsize=8)
+def parse_properties_file(path, modification_time_ns, size):
     properties = {}
     with open(path, "r") as file:
         for line in file:
@@ -117,14 +207,16 @@ def read_properties_file(path):
             properties[key.strip()] = value.strip()
     return properties
 
+def read_properties_file(path):
+    file_stat = os.stat(path)
+    return dict(parse_properties_file(path, file_stat.st_mtime_ns, file_stat.st_size))
+
 #endregion Core
 
 #region SDK helpers
 
 def read_sdk_json():
-    json_file_path = os.path.join(ttbuild_path, "tool.json")
-    with open(json_file_path) as json_file:
-        return json.load(json_file)
+    return read_json_file(ttbuild_tool_json_path)
 
 def get_sdk_dir(version, platform):
     global use_local_sdk, local_base_path
@@ -165,21 +257,21 @@ def sdk_exists(version, platform):
 
 def should_update_tool_json():
     global ttbuild_cdn
-    json_filepath = os.path.join(ttbuild_path, "tool.json")
-    if os.path.exists(json_filepath):
-        json_modification_time = os.path.getmtime(json_filepath)
+    json_filepath = ttbuild_tool_json_path
+    json_stat = stat_or_none(json_filepath)
+    if json_stat is not None:
         now = time.time()
         global ttbuild_sdk_json_validity
         minimum_seconds_difference = ttbuild_sdk_json_validity
-        return (now - json_modification_time) > minimum_seconds_difference
+        return (now - json_stat.st_mtime) > minimum_seconds_difference
     else:
         return True
 
 def update_tool_json():
     global ttbuild_cdn, ttbuild_path
     json_url = f"{ttbuild_cdn}/sdk/tool.json"
-    json_filepath = os.path.join(ttbuild_path, "tool.json")
-    return download_file(json_url, json_filepath)
+    json_filepath = ttbuild_tool_json_path
+    return download_file(json_url, json_filepath, conditional=True)
 
 def should_fetch_sdkconfig_files(platform_targets):
     for platform in platform_targets:
@@ -188,12 +280,20 @@ def should_fetch_sdkconfig_files(platform_targets):
             return True
     return False
 
+def fetch_sdkconfig_file(platform):
+    sdkconfig_filename = f"sdkconfig.app.{platform}"
+    target_path = os.path.join(ttbuild_path, sdkconfig_filename)
+    return download_file(f"{ttbuild_cdn}/sdk/{sdkconfig_filename}", target_path)
+
 def fetch_sdkconfig_files(platform_targets):
-    for platform in platform_targets:
-        sdkconfig_filename = f"sdkconfig.app.{platform}"
-        target_path = os.path.join(ttbuild_path, sdkconfig_filename)
-        if not download_file(f"{ttbuild_cdn}/sdk/{sdkconfig_filename}", target_path):
-            exit_with_error(f"Failed to download sdkconfig file for {platform}")
+    worker_count = min(ttbuild_max_download_workers, len(platform_targets))
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = {executor.submit(fetch_sdkconfig_file, platform): platform for platform in platform_targets}
+        for future in as_completed(futures):
+            if not future.result():
+                for pending in futures:
+                    pending.cancel()
+                exit_with_error(f"Failed to download sdkconfig file for {futures[future]}")
 
 #endregion SDK helpers
 
@@ -201,7 +301,7 @@ def fetch_sdkconfig_files(platform_targets):
 
 def validate_environment():
     if os.environ.get("IDF_PATH") is None:
-        if sys.platform == "win32":
+        if is_windows:
             exit_with_error("Cannot find the Espressif IDF SDK. Ensure it is installed and that it is activated via %IDF_PATH%\\export.ps1")
         else:
             exit_with_error("Cannot find the Espressif IDF SDK. Ensure it is installed and that it is activated via $PATH_TO_IDF_SDK/export.sh")
@@ -213,6 +313,10 @@ def validate_environment():
     elif use_local_sdk == True and os.environ.get("TACTILITY_SDK_PATH") is None:
         exit_with_error("local build was requested, but TACTILITY_SDK_PATH environment variable is not set.")
 
+@functools.lru_cache(maxsize=32)
+def compile_pattern(pattern):
+    return re.compile(pattern)
+
 def validate_self(sdk_json):
     if not "toolVersion" in sdk_json:
         exit_with_error("Server returned invalid SDK data format (toolVersion not found)")
@@ -225,7 +329,7 @@ def validate_self(sdk_json):
     if tool_version != ttbuild_version:
         print_warning(f"New version available: {tool_version} (currently using {ttbuild_version})")
         print_warning(f"Run 'tactility.py updateself' to update.")
-    if re.search(tool_compatibility, ttbuild_version) is None:
+    if compile_pattern(tool_compatibility).search(ttbuild_version) is None:
         print_error("The tool is not compatible anymore.")
         print_error("Run 'tactility.py updateself' to update.")
         sys.exit(1)
@@ -242,9 +346,16 @@ def validate_manifest(manifest):
         if key not in manifest:
             exit_with_error(f"Invalid manifest format: {key} not found")
 
+# Cached by value: the tuple is immutable, so it's safe to share between callers
+@functools.lru_cache(maxsize=None)
+def parse_platforms(platforms_value):
+    return tuple(platforms_value.split(","))
+
+def get_manifest_platforms(manifest):
+    return list(parse_platforms(manifest["target.platforms"]))
+
 def is_valid_manifest_platform(manifest, platform):
-    manifest_platforms = manifest["target.platforms"].split(",")
-    return platform in manifest_platforms
+    return platform in parse_platforms(manifest["target.platforms"])
 
 def validate_manifest_platform(manifest, platform):
     if not is_valid_manifest_platform(manifest, platform):
@@ -252,7 +363,7 @@ def validate_manifest_platform(manifest, platform):
 
 def get_manifest_target_platforms(manifest, requested_platform):
     if requested_platform == "" or requested_platform is None:
-        return manifest["target.platforms"].split(",")
+        return get_manifest_platforms(manifest)
     else:
         validate_manifest_platform(manifest, requested_platform)
         return [requested_platform]
@@ -261,23 +372,26 @@ def get_manifest_target_platforms(manifest, requested_platform):
 
 #region SDK download
 
+# Entry names are validated as strings, so only the target folder has to be resolved on disk.
+# extractall() also sanitizes names, but silently: entries that try to escape the target folder are rejected here instead.
 def safe_extract_zip(zip_ref, target_dir):
     target_dir = os.path.realpath(target_dir)
     for member in zip_ref.infolist():
-        dest = os.path.realpath(os.path.join(target_dir, member.filename))
-        if not dest.startswith(target_dir + os.sep):
+        path = PurePosixPath(member.filename.replace("\\", "/"))
+        has_drive = len(path.parts) > 0 and path.parts[0][1:2] == ":"
+        if path.is_absolute() or has_drive or ".." in path.parts:
             raise ValueError(f"Invalid zip entry: {member.filename}")
     zip_ref.extractall(target_dir)
 
 def sdk_download(version, platform):
     sdk_root_dir = get_sdk_root_dir(version, platform)
-    os.makedirs(sdk_root_dir, exist_ok=True)
+    ensure_directory(sdk_root_dir)
     sdk_index_url = get_sdk_url(version, "index.json")
     print(f"Downloading SDK version {version} for {platform}")
     sdk_index_filepath = os.path.join(sdk_root_dir, "index.json")
     if verbose:
         print(f"Downloading {sdk_index_url} to {sdk_index_filepath}")
-    if not download_file(sdk_index_url, sdk_index_filepath):
+    if not download_file(sdk_index_url, sdk_index_filepath, conditional=True):
         # TODO: 404 check, print a more accurate error
         print_error(f"Failed to download SDK version {version}. Check your internet connection and make sure this release exists.")
         return False
@@ -295,18 +409,38 @@ def sdk_download(version, platform):
     if not download_file(sdk_zip_source_url, sdk_zip_target_filepath):
         print_error(f"Failed to download {sdk_zip_source_url} to {sdk_zip_target_filepath}")
         return False
+    # Extract to a temporary folder first: sdk_exists() treats any TactilitySDK folder as a complete SDK
+    sdk_dir = os.path.join(sdk_root_dir, "TactilitySDK")
+    partial_sdk_dir = f"{sdk_dir}.part"
+    if os.path.isdir(partial_sdk_dir):
+        shutil.rmtree(partial_sdk_dir)
     with zipfile.ZipFile(sdk_zip_target_filepath, "r") as zip_ref:
-        safe_extract_zip(zip_ref, os.path.join(sdk_root_dir, "TactilitySDK"))
+        safe_extract_zip(zip_ref, partial_sdk_dir)
+    if os.path.isdir(sdk_dir):
+        shutil.rmtree(sdk_dir)
+    os.replace(partial_sdk_dir, sdk_dir)
+    # The extracted SDK is what gets cached, so the archive is no longer needed
+    os.remove(sdk_zip_target_filepath)
     return True
 
 def sdk_download_all(version, platforms):
+    platforms_to_download = []
     for platform in platforms:
         if not sdk_exists(version, platform):
-            if not sdk_download(version, platform):
+            platforms_to_download.append(platform)
+        elif verbose:
+            print(f"Using cached download for SDK version {version} and platform {platform}")
+    if not platforms_to_download:
+        return True
+    # Downloads are I/O bound, so the platforms are fetched concurrently
+    worker_count = min(ttbuild_max_download_workers, len(platforms_to_download))
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = [executor.submit(sdk_download, version, platform) for platform in platforms_to_download]
+        for future in as_completed(futures):
+            if not future.result():
+                for pending in futures:
+                    pending.cancel()
                 return False
-        else:
-            if verbose:
-                print(f"Using cached download for SDK version {version} and platform {platform}")
     return True
 
 #endregion SDK download
@@ -316,48 +450,144 @@ def sdk_download_all(version, platforms):
 def get_cmake_path(platform):
     return os.path.join("build", f"cmake-build-{platform}")
 
+# The result is cached because it's looked up several times per build.
+# Call find_elf_file.cache_clear() whenever an ELF file is created or removed.
+@functools.lru_cache(maxsize=None)
 def find_elf_file(platform):
     cmake_dir = get_cmake_path(platform)
-    if os.path.exists(cmake_dir):
-        for file in os.listdir(cmake_dir):
-            if file.endswith(".app.elf"):
-                return os.path.join(cmake_dir, file)
-    return None
+    try:
+        with os.scandir(cmake_dir) as entries:
+            return next((entry.path for entry in entries if entry.name.endswith(".app.elf")), None)
+    except FileNotFoundError:
+        return None
+
+# ESP-IDF expands the copied file in place, so the source is compared with a stamp of the previously copied source
+# rather than with the destination. The stamp also holds stamp_key: the build inputs (e.g. the SDK location) that
+# are only read when CMake configures. The destination is left untouched when neither changed,
+# so its mtime doesn't trigger a CMake reconfigure.
+# The regular copy is used otherwise: keeping the source mtime (copy2) could hide a change from CMake.
+def copy_if_changed(source_path, target_path, stamp_path, stamp_key):
+    with open(source_path, "rb") as source_file:
+        stamp = stamp_key.encode() + b"\n" + source_file.read()
+    if os.path.isfile(target_path):
+        try:
+            with open(stamp_path, "rb") as stamp_file:
+                if stamp_file.read() == stamp:
+                    return
+        except OSError:
+            pass
+    shutil.copy(source_path, target_path)
+    with open(stamp_path, mode="wb") as stamp_file:
+        stamp_file.write(stamp)
+
+# Returns a tuple: whether the build succeeded, and the captured build output to show when it failed
+def build_platform(version, platform, skip_build):
+    # First build command must be "idf.py build", otherwise it fails to execute "idf.py elf"
+    # We check if the ELF file exists and run the correct command
+    # This can lead to code caching issues, so sometimes a clean build is required
+    if find_elf_file(platform) is None:
+        return build_first(version, platform, skip_build)
+    else:
+        return build_consecutively(version, platform, skip_build)
 
-def build_all(version, platforms, skip_build):
+def print_build_result(platform, succeeded, build_output):
+    if succeeded:
+        print_status_success(f"Building {platform} ELF")
+    else:
+        if build_output is not None:
+            print(build_output, end="")
+        print_status_error(f"Building {platform} ELF")
+
+def build_all_sequentially(version, platforms, skip_build):
     for platform in platforms:
-        # First build command must be "idf.py build", otherwise it fails to execute "idf.py elf"
-        # We check if the ELF file exists and run the correct command
-        # This can lead to code caching issues, so sometimes a clean build is required
-        if find_elf_file(platform) is None:
-            if not build_first(version, platform, skip_build):
-                return False
-        else:
-            if not build_consecutively(version, platform, skip_build):
+        if not skip_build:
+            print_status_busy(f"Building {platform} ELF")
+        succeeded, build_output = build_platform(version, platform, skip_build)
+        if not skip_build:
+            print_build_result(platform, succeeded, build_output)
+        if not succeeded:
+            return False
+    return True
+
+# Every platform has its own build folder, sdkconfig and environment, but the builds still share the project folder:
+# project-level files (e.g. the component manager's dependencies.lock) aren't isolated, so this is opt-in via --jobs.
+# The results are printed from this thread, so the console output of concurrent builds doesn't get mixed up.
+def build_all_concurrently(version, platforms, skip_build, worker_count):
+    build_failed = threading.Event()
+    def build_unless_failed(platform):
+        # Queued builds are skipped once a build has failed: None tells them apart from failed builds
+        if build_failed.is_set():
+            return None
+        succeeded, build_output = build_platform(version, platform, skip_build)
+        if not succeeded:
+            build_failed.set()
+        return succeeded, build_output
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = {executor.submit(build_unless_failed, platform): platform for platform in platforms}
+        remaining_platforms = list(platforms)
+        if not skip_build:
+            print_status_busy(f"Building {remaining_platforms} ELF")
+        for future in as_completed(futures):
+            platform = futures[future]
+            remaining_platforms.remove(platform)
+            result = future.result()
+            if result is None:
+                continue
+            succeeded, build_output = result
+            if not skip_build:
+                print_build_result(platform, succeeded, build_output)
+            if not succeeded:
+                for pending in futures:
+                    pending.cancel()
                 return False
+            if remaining_platforms and not skip_build:
+                print_status_busy(f"Building {remaining_platforms} ELF")
     return True
 
-def wait_for_process(process):
-    buffer = []
-    if sys.platform != "win32":
-        os.set_blocking(process.stdout.fileno(), False)
-    while process.poll() is None:
-        while True:
-            line = process.stdout.readline()
-            if line:
-                decoded_line = line.decode("UTF-8")
-                if decoded_line != "":
-                    buffer.append(decoded_line)
-                else:
-                    break
-            else:
-                break
-    # Read any remaining output
-    for line in process.stdout:
-        decoded_line = line.decode("UTF-8")
-        if decoded_line:
-            buffer.append(decoded_line)
-    return buffer
+# Verbose builds run one at a time, to keep their console output readable.
+# idf.py already runs its compile jobs on all cores, so --jobs is capped at a quarter of the CPU count.
+def build_all(version, platforms, skip_build):
+    if verbose:
+        worker_count = 1
+    else:
+        worker_count = min(len(platforms), build_jobs, max(1, (os.cpu_count() or 1) // 4))
+    if worker_count <= 1:
+        return build_all_sequentially(version, platforms, skip_build)
+    else:
+        return build_all_concurrently(version, platforms, skip_build, worker_count)
+
+# Each platform gets its own sdkconfig inside its build folder, so concurrent builds don't overwrite each other's config
+# Changing the SDK or ESP-IDF re-stages the sdkconfig, which makes CMake reconfigure with the new paths.
+def stage_sdkconfig(platform, sdk_dir):
+    cmake_path = get_cmake_path(platform)
+    ensure_directory(cmake_path)
+    sdkconfig_path = os.path.join(ttbuild_path, f"sdkconfig.app.{platform}")
+    staged_sdkconfig_path = os.path.abspath(os.path.join(cmake_path, "sdkconfig"))
+    stamp_key = f"{os.path.abspath(sdk_dir)}\n{os.environ.get('IDF_PATH', '')}"
+    copy_if_changed(sdkconfig_path, staged_sdkconfig_path, os.path.join(cmake_path, "sdkconfig.source"), stamp_key)
+    return staged_sdkconfig_path
+
+def get_build_environment(sdk_dir):
+    build_environment = os.environ.copy()
+    build_environment["TACTILITY_SDK_PATH"] = sdk_dir
+    return build_environment
+
+# In verbose mode the output goes straight to the console while the build runs.
+# Otherwise it's captured, and returned as bytes so it can be shown when the build fails.
+def run_build_command(build_command, build_environment):
+    if verbose:
+        print(f"Running command: {' '.join(build_command)}")
+        sys.stdout.flush()
+        return subprocess.run(build_command, env=build_environment, shell=shell_needed).returncode, None
+    result = subprocess.run(build_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=build_environment, shell=shell_needed)
+    return result.returncode, result.stdout
+
+# Only decoded when a build failed, as that's the only time the output is shown.
+# Compiler output isn't guaranteed to be valid UTF-8 (e.g. localized messages on Windows)
+def decode_build_output(build_output):
+    if build_output is None:
+        return None
+    return build_output.decode("UTF-8", errors="replace")
 
 # The first build must call "idf.py build" and consecutive builds must call "idf.py elf" as it finishes faster.
 # The problem is that the "idf.py build" always results in an error, even though the elf file is created.
@@ -366,119 +596,133 @@ def build_first(version, platform, skip_build):
     sdk_dir = get_sdk_dir(version, platform)
     if verbose:
         print(f"Using SDK at {sdk_dir}")
-    os.environ["TACTILITY_SDK_PATH"] = sdk_dir
-    sdkconfig_path = os.path.join(ttbuild_path, f"sdkconfig.app.{platform}")
-    shutil.copy(sdkconfig_path, "sdkconfig")
+    build_environment = get_build_environment(sdk_dir)
+    sdkconfig_path = stage_sdkconfig(platform, sdk_dir)
     elf_path = find_elf_file(platform)
     # Remove previous elf file: re-creation of the file is used to measure if the build succeeded,
     # as the actual build job will always fail due to technical issues with the elf cmake script
     if elf_path is not None:
         os.remove(elf_path)
+        find_elf_file.cache_clear()
     if skip_build:
-        return True
-    print(f"Building first {platform} build")
-    cmake_path = get_cmake_path(platform)
-    print_status_busy(f"Building {platform} ELF")
-    shell_needed = sys.platform == "win32"
-    build_command = ["idf.py", "-B", cmake_path, "build"]
+        return True, None
     if verbose:
-        print(f"Running command: {' '.join(build_command)}")
-    with subprocess.Popen(build_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell_needed) as process:
-        build_output = wait_for_process(process)
-        # The return code is never expected to be 0 due to a bug in the elf cmake script, but we keep it just in case
-        if process.returncode == 0:
-            print(f"{shell_color_green}Building for {platform} ✅{shell_color_reset}")
-            return True
-        else:
-            if find_elf_file(platform) is None:
-                for line in build_output:
-                    print(line, end="")
-                print_status_error(f"Building {platform} ELF")
-                return False
-            else:
-                print_status_success(f"Building {platform} ELF")
-                return True
+        print(f"Building first {platform} build")
+    cmake_path = get_cmake_path(platform)
+    build_command = ["idf.py", "-B", cmake_path, "-D", f"SDKCONFIG={sdkconfig_path}", "build"]
+    return_code, build_output = run_build_command(build_command, build_environment)
+    find_elf_file.cache_clear()
+    # The return code is never expected to be 0 due to a bug in the elf cmake script, but we keep it just in case
+    if return_code == 0 or find_elf_file(platform) is not None:
+        return True, None
+    else:
+        return False, decode_build_output(build_output)
 
 def build_consecutively(version, platform, skip_build):
     sdk_dir = get_sdk_dir(version, platform)
     if verbose:
         print(f"Using SDK at {sdk_dir}")
-    os.environ["TACTILITY_SDK_PATH"] = sdk_dir
-    sdkconfig_path = os.path.join(ttbuild_path, f"sdkconfig.app.{platform}")
-    shutil.copy(sdkconfig_path, "sdkconfig")
+    build_environment = get_build_environment(sdk_dir)
+    sdkconfig_path = stage_sdkconfig(platform, sdk_dir)
     if skip_build:
-        return True
+        return True, None
     cmake_path = get_cmake_path(platform)
-    print_status_busy(f"Building {platform} ELF")
-    shell_needed = sys.platform == "win32"
-    build_command = ["idf.py", "-B", cmake_path, "elf"]
-    if verbose:
-        print(f"Running command: {' '.join(build_command)}")
-    with subprocess.Popen(build_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell_needed) as process:
-        build_output = wait_for_process(process)
-        if process.returncode == 0:
-            print_status_success(f"Building {platform} ELF")
-            return True
-        else:
-            for line in build_output:
-                print(line, end="")
-            print_status_error(f"Building {platform} ELF")
-            return False
+    build_command = ["idf.py", "-B", cmake_path, "-D", f"SDKCONFIG={sdkconfig_path}", "elf"]
+    return_code, build_output = run_build_command(build_command, build_environment)
+    find_elf_file.cache_clear()
+    if return_code == 0:
+        return True, None
+    else:
+        return False, decode_build_output(build_output)
 
 #endregion Building
 
 #region Packaging
 
-def package_intermediate_manifest(target_path):
+# Returns the (source path, archive name) pairs that make up the package, or None when an input is missing
+def package_inputs(platforms):
     if not os.path.isfile("manifest.properties"):
         print_error("manifest.properties not found")
-        return False
-    shutil.copy("manifest.properties", os.path.join(target_path, "manifest.properties"))
-    return True
-
-def package_intermediate_binaries(target_path, platforms):
-    elf_dir = os.path.join(target_path, "elf")
-    os.makedirs(elf_dir, exist_ok=True)
+        return None
+    inputs = [("manifest.properties", "manifest.properties")]
     for platform in platforms:
         elf_path = find_elf_file(platform)
         if elf_path is None:
             print_error(f"ELF file not found for {platform}")
-            return False
-        shutil.copy(elf_path, os.path.join(elf_dir, f"{platform}.elf"))
-    return True
-
-def package_intermediate_assets(target_path):
+            return None
+        inputs.append((elf_path, f"elf/{platform}.elf"))
     if os.path.isdir("assets"):
-        shutil.copytree("assets", os.path.join(target_path, "assets"), dirs_exist_ok=True)
-
-def package_intermediate(platforms):
-    target_path = os.path.join("build", "package-intermediate")
-    if os.path.isdir(target_path):
-        shutil.rmtree(target_path)
-    os.makedirs(target_path, exist_ok=True)
-    if not package_intermediate_manifest(target_path):
-        return False
-    if not package_intermediate_binaries(target_path, platforms):
-        return False
-    package_intermediate_assets(target_path)
-    return True
+        # Symlinks are followed, as the package contains the files they point to
+        for root, dirs, files in os.walk("assets", followlinks=True):
+            dirs.sort()
+            for file in sorted(files):
+                asset_path = os.path.join(root, file)
+                inputs.append((asset_path, asset_path.replace(os.sep, "/")))
+    return inputs
+
+def package_signature(inputs):
+    signature = hashlib.blake2b(digest_size=16)
+    for path, arcname in inputs:
+        stat_result = os.stat(path)
+        signature.update(f"{arcname}:{path}:{stat_result.st_mtime_ns}:{stat_result.st_size}\n".encode())
+    return signature.hexdigest()
+
+def read_package_signature(signature_path):
+    try:
+        with open(signature_path) as signature_file:
+            return signature_file.read().strip()
+    except OSError:
+        return None
 
 def package_name(platforms):
     elf_path = find_elf_file(platforms[0])
     elf_base_name = os.path.basename(elf_path).removesuffix(".app.elf")
     return os.path.join("build", f"{elf_base_name}.app")
 
+def tar_add_directory(tar, arcname):
+    info = tarfile.TarInfo(arcname)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = int(time.time())
+    tar.addfile(info)
+
+# The package is written directly from the build outputs, with the same layout as the former package-intermediate folder
+def package_write(tar_path, platforms):
+    # dereference: symlinks are stored as the files they point to, because the device can't resolve them
+    with tarfile.open(tar_path, mode="w|", format=tarfile.USTAR_FORMAT, dereference=True) as tar:
+        tar_add_directory(tar, "")
+        if os.path.isdir("assets"):
+            tar.add("assets", arcname="assets")
+        tar_add_directory(tar, "elf")
+        for platform in sorted(platforms):
+            tar.add(find_elf_file(platform), arcname=f"elf/{platform}.elf")
+        tar.add("manifest.properties", arcname="manifest.properties")
+
 def package_all(platforms):
     status = f"Building package with {platforms}"
     print_status_busy(status)
-    if not package_intermediate(platforms):
+    inputs = package_inputs(platforms)
+    if inputs is None:
         print_status_error("Building package failed: missing inputs")
         return False
     # Create build/something.app
     try:
         tar_path = package_name(platforms)
-        with tarfile.open(tar_path, mode="w", format=tarfile.USTAR_FORMAT) as tar:
-            tar.add(os.path.join("build", "package-intermediate"), arcname="")
+        # The signature of the inputs is stored next to the package, so unchanged packages aren't rebuilt
+        signature_path = f"{tar_path}.sig"
+        signature = package_signature(inputs)
+        if os.path.isfile(tar_path) and read_package_signature(signature_path) == signature:
+            if verbose:
+                print(f"Package {tar_path} is up to date")
+            print_status_success(status)
+            return True
+        try:
+            os.remove(signature_path)
+        except FileNotFoundError:
+            pass
+        package_write(tar_path, platforms)
+        with open(signature_path, mode="w") as signature_file:
+            signature_file.write(signature)
         print_status_success(status)
         return True
     except Exception as e:
@@ -489,7 +733,7 @@ def package_all(platforms):
 
 def setup_environment():
     global ttbuild_path
-    os.makedirs(ttbuild_path, exist_ok=True)
+    ensure_directory(ttbuild_path)
 
 def build_action(manifest, platform_arg, skip_build):
     # Environment validation
@@ -531,6 +775,7 @@ def clear_cache_action():
     if os.path.exists(ttbuild_path):
         print_status_busy(f"Removing {ttbuild_path}/")
         shutil.rmtree(ttbuild_path)
+        ensured_directories.clear()
         print_status_success(f"Removed {ttbuild_path}/")
     else:
         print("Nothing to clear")
@@ -547,7 +792,7 @@ def get_device_info(ip):
     print_status_busy(f"Requesting device info")
     url = get_url(ip, "/info")
     try:
-        response = requests.get(url, timeout=http_timeout_seconds)
+        response = http_session.get(url, timeout=http_timeout_seconds)
         if response.status_code != 200:
             print_error("Run failed")
         else:
@@ -562,7 +807,7 @@ def run_action(manifest, ip):
     url = get_url(ip, "/app/run")
     params = {'id': app_id}
     try:
-        response = requests.post(url, params=params, timeout=http_timeout_seconds)
+        response = http_session.post(url, params=params, timeout=http_timeout_seconds)
         if response.status_code != 200:
             print_error("Run failed")
         else:
@@ -570,6 +815,40 @@ def run_action(manifest, ip):
     except requests.RequestException as e:
         print_status_error(f"Running request failed: {e}")
 
+# A multipart/form-data body with a single file field that is read from disk while it's being sent.
+# requests only streams file-like bodies, so "files=" would encode the whole package in memory first.
+class MultipartFileBody:
+    def __init__(self, field_name, file):
+        boundary = os.urandom(16).hex()
+        filename = os.path.basename(file.name)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        header = f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field_name}\"; filename=\"{filename}\"\r\n\r\n".encode()
+        footer = f"\r\n--{boundary}--\r\n".encode()
+        self.length = len(header) + os.fstat(file.fileno()).st_size + len(footer)
+        self.parts = [io.BytesIO(header), file, io.BytesIO(footer)]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(65536)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
 def install_action(ip, platforms):
     print_status_busy("Installing")
     for platform in platforms:
@@ -583,10 +862,11 @@ def install_action(ip, platforms):
     try:
         # Prepare multipart form data
         with open(package_path, 'rb') as file:
-            files = {
-                'elf': file
+            body = MultipartFileBody('elf', file)
+            headers = {
+                'Content-Type': body.content_type
             }
-            response = requests.put(url, files=files, timeout=http_timeout_seconds)
+            response = http_session.put(url, data=body, headers=headers, timeout=http_timeout_seconds)
             if response.status_code != 200:
                 print_status_error("Install failed")
                 return False
@@ -606,7 +886,7 @@ def uninstall_action(manifest, ip):
     url = get_url(ip, "/app/uninstall")
     params = {'id': app_id}
     try:
-        response = requests.put(url, params=params, timeout=http_timeout_seconds)
+        response = http_session.put(url, params=params, timeout=http_timeout_seconds)
         if response.status_code != 200:
             print_status_error("Server responded that uninstall failed")
         else:
@@ -616,25 +896,79 @@ def uninstall_action(manifest, ip):
 
 #region Main
 
+# The action handlers receive the manifest and the arguments that follow the action name
+
+def handle_build(manifest, arguments):
+    platform = arguments[0] if arguments else None
+    if not build_action(manifest, platform, skip_build):
+        sys.exit(1)
+
+def handle_clean(manifest, arguments):
+    clean_action()
+
+def handle_clear_cache(manifest, arguments):
+    clear_cache_action()
+
+def handle_update_self(manifest, arguments):
+    update_self_action()
+
+def handle_run(manifest, arguments):
+    run_action(manifest, arguments[0])
+
+def get_install_platforms(manifest, arguments):
+    if len(arguments) >= 2:
+        return [arguments[1]]
+    else:
+        return get_manifest_platforms(manifest)
+
+def handle_install(manifest, arguments):
+    install_action(arguments[0], get_install_platforms(manifest, arguments))
+
+def handle_uninstall(manifest, arguments):
+    uninstall_action(manifest, arguments[0])
+
+def handle_build_install_run(manifest, arguments):
+    platform = arguments[1] if len(arguments) >= 2 else None
+    if build_action(manifest, platform, skip_build):
+        if install_action(arguments[0], get_install_platforms(manifest, arguments)):
+            run_action(manifest, arguments[0])
+
+# Action name: (required argument count, handler)
+commands = {
+    "build": (0, handle_build),
+    "clean": (0, handle_clean),
+    "clearcache": (0, handle_clear_cache),
+    "updateself": (0, handle_update_self),
+    "run": (1, handle_run),
+    "install": (1, handle_install),
+    "uninstall": (1, handle_uninstall),
+    "bir": (1, handle_build_install_run),
+    "brrr": (1, handle_build_install_run)
+}
+
+option_flags = {"--help", "--verbose", "--skip-build", "--local-sdk"}
+
 if __name__ == "__main__":
     print(f"Tactility Build System v{ttbuild_version}")
-    if "--help" in sys.argv:
+    flags = option_flags.intersection(sys.argv)
+    if "--help" in flags:
         print_help()
         sys.exit()
     # Argument validation
     if len(sys.argv) == 1:
         print_help()
         sys.exit(1)
-    if "--verbose" in sys.argv:
-        verbose = True
-        sys.argv.remove("--verbose")
-    skip_build = False
-    if "--skip-build" in sys.argv:
-        skip_build = True
-        sys.argv.remove("--skip-build")
-    if "--local-sdk" in sys.argv:
-        use_local_sdk = True
-        sys.argv.remove("--local-sdk")
+    verbose = "--verbose" in flags
+    skip_build = "--skip-build" in flags
+    use_local_sdk = "--local-sdk" in flags
+    sys.argv = [argument for argument in sys.argv if argument not in flags]
+    if "--jobs" in sys.argv:
+        jobs_index = sys.argv.index("--jobs")
+        jobs_value = sys.argv[jobs_index + 1] if jobs_index + 1 < len(sys.argv) else ""
+        if not jobs_value.isdigit() or int(jobs_value) < 1:
+            exit_with_error("--jobs requires a positive number")
+        build_jobs = int(jobs_value)
+        del sys.argv[jobs_index:jobs_index + 2]
     
     # Check if the first argument is a path to an app directory
     if len(sys.argv) > 2:
@@ -650,6 +984,7 @@ if __name__ == "__main__":
         sys.exit(1)
     
     action_arg = sys.argv[1]
+    action_arguments = sys.argv[2:]
 
     # Environment setup
     setup_environment()
@@ -657,60 +992,17 @@ if __name__ == "__main__":
         exit_with_error("manifest.properties not found")
     manifest = read_manifest()
     validate_manifest(manifest)
-    all_platform_targets = manifest["target.platforms"].split(",")
     # Update SDK cache (tool.json)
     if not use_local_sdk and should_update_tool_json() and not update_tool_json():
         exit_with_error("Failed to retrieve SDK info")
     # Actions
-    if action_arg == "build":
-        if len(sys.argv) < 2:
-            print_help()
-            exit_with_error("Commandline parameter missing")
-        platform = None
-        if len(sys.argv) > 2:
-            platform = sys.argv[2]
-        if not build_action(manifest, platform, skip_build):
-            sys.exit(1)
-    elif action_arg == "clean":
-        clean_action()
-    elif action_arg == "clearcache":
-        clear_cache_action()
-    elif action_arg == "updateself":
-        update_self_action()
-    elif action_arg == "run":
-        if len(sys.argv) < 3:
-            print_help()
-            exit_with_error("Commandline parameter missing")
-        run_action(manifest, sys.argv[2])
-    elif action_arg == "install":
-        if len(sys.argv) < 3:
-            print_help()
-            exit_with_error("Commandline parameter missing")
-        platform = None
-        platforms_to_install = all_platform_targets
-        if len(sys.argv) >= 4:
-            platform = sys.argv[3]
-            platforms_to_install = [platform]
-        install_action(sys.argv[2], platforms_to_install)
-    elif action_arg == "uninstall":
-        if len(sys.argv) < 3:
-            print_help()
-            exit_with_error("Commandline parameter missing")
-        uninstall_action(manifest, sys.argv[2])
-    elif action_arg == "bir" or action_arg == "brrr":
-        if len(sys.argv) < 3:
-            print_help()
-            exit_with_error("Commandline parameter missing")
-        platform = None
-        platforms_to_install = all_platform_targets
-        if len(sys.argv) >= 4:
-            platform = sys.argv[3]
-            platforms_to_install = [platform]
-        if build_action(manifest, platform, skip_build):
-            if install_action(sys.argv[2], platforms_to_install):
-                run_action(manifest, sys.argv[2])
-    else:
+    if action_arg not in commands:
         print_help()
         exit_with_error("Unknown commandline parameter")
+    required_argument_count, handler = commands[action_arg]
+    if len(action_arguments) < required_argument_count:
+        print_help()
+        exit_with_error("Commandline parameter missing")
+    handler(manifest, action_arguments)
 
 #endregion Main